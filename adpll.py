@@ -28,11 +28,13 @@ class ADPLL():
                  freq_adj_factor,
                  phase_adj_factor,
                  debug = False):
-        self.di = di
+        # di may be any iterable of transition deltas in seconds
+        self.di = iter(di)
         self.osc_period = osc_period
         self.window_frac = window_pct / 100
         self.freq_adj_factor = freq_adj_factor
         self.phase_adj_factor = phase_adj_factor
+        self._adj_enabled = freq_adj_factor != 0 or phase_adj_factor != 0
 
         self.debug = debug
         self.debug_all = False
@@ -40,66 +42,83 @@ class ADPLL():
         self.min_osc_period = self.osc_period * (100 - max_adj_pct) / 100
         self.max_osc_period = self.osc_period * (100 + max_adj_pct) / 100
 
-        self.zero_bits = 0
+        self.bit_iter = None
 
         # start oscillator locked to first transition
-        self.trans_time = di.__next__()
+        self.trans_time = next(self.di)
         self.osc_time = self.trans_time
         #print("first transition at %g" % self.trans_time)
 
+    # The bits are produced all at once by decode_all(), and iteration
+    # then runs over the resulting buffer, rather than calling back into
+    # Python for every bit.
     def __iter__(self):
-        return self
+        if self.bit_iter is None:
+            self.bit_iter = iter(self.decode_all())
+        return self.bit_iter
 
     def __next__(self):
-        if self.zero_bits != 0:
-            self.zero_bits -= 1
-            return 0
-
-        # We're going to return a one. Now deal with the next transition
-        hbi = 0
-
-        while hbi <= 0:
-            self.trans_time += self.di.__next__()
-            q = (self.trans_time - self.osc_time) / self.osc_period
+        return next(iter(self))
+
+    # Runs the PLL over all of the remaining flux transitions, returning
+    # a bytearray with one element (0 or 1) per half-bit cell. The PLL
+    # state is kept in locals for the loop and stored back at the end.
+    def decode_all(self):
+        osc_period = self.osc_period
+        osc_time = self.osc_time
+        trans_time = self.trans_time
+        min_osc_period = self.min_osc_period
+        max_osc_period = self.max_osc_period
+        window_frac = self.window_frac
+        freq_adj_factor = self.freq_adj_factor
+        phase_adj_factor = self.phase_adj_factor
+        debug = self.debug
+        debug_all = self.debug_all
+        adj_enabled = self._adj_enabled
+
+        bits = bytearray()
+        append = bits.append
+        extend = bits.extend
+        for delta in self.di:
+            trans_time += delta
+            q = (trans_time - osc_time) / osc_period
             hbi = int(q + 0.5)
-            self.osc_time += hbi * self.osc_period
-            error = (self.trans_time - self.osc_time)
-
-            # if (hbi <= 0):
-            #     # Hopefully this only happens outside ID & data fields,
-            #     # e.g., in write splices
-            #     print("transition too soon")
-            #     print("%g, %d, %g" % (q, hbi, error))
-
-        #print("%g, %d, %g" % (q, hbi, error))
-        if self.debug_all or (self.debug and (abs(error) > (self.osc_period * self.window_frac))):
-            print("transition outside window")
-            print("transition at time %g us" % (self.trans_time * 1.0e6))
-            print("oscillator at time %g us" % (self.osc_time * 1.0e6))
-            print("q = %f" % q)
-            print("hbi = %f" % hbi)
-            print("new osc time %g us" % (self.osc_time * 1.0e6))
-            print("error %g" % error)
-            print("osc period %g us " % (self.osc_period * 1.0e6))
-            print("error limit %g us" % (self.osc_period * self.window_frac * 1.0e6))
-        if True:  # was else for previous if statement
-            if self.freq_adj_factor != 0:
-                adj = error * self.freq_adj_factor
-                self.osc_period += adj
-                if self.osc_period < self.min_osc_period:
-                    self.osc_period = self.min_osc_period
-                    #print("osc period clipped to min")
-                elif self.osc_period > self.max_osc_period:
-                    self.osc_period = self.max_osc_period
-                    #print("osc period clipped to max")
-                #print("osc period adjusted by %g to %g" % (adj, self.osc_period))
-            if self.phase_adj_factor != 0:
-                adj = error * self.phase_adj_factor
-                self.osc_time += adj
-
-        self.zero_bits = hbi - 1
-        #print("hbi=%d, %d zeros" % (hbi, self.zero_bits))
-        
-        return 1
-
+            osc_time += hbi * osc_period
+            error = (trans_time - osc_time)
+
+            if hbi <= 0:
+                # Hopefully this only happens outside ID & data fields,
+                # e.g., in write splices
+                #print("transition too soon")
+                #print("%g, %d, %g" % (q, hbi, error))
+                continue
+
+            #print("%g, %d, %g" % (q, hbi, error))
+            if debug_all or (debug and (abs(error) > (osc_period * window_frac))):
+                print("transition outside window")
+                print("transition at time %g us" % (trans_time * 1.0e6))
+                print("oscillator at time %g us" % (osc_time * 1.0e6))
+                print("q = %f" % q)
+                print("hbi = %f" % hbi)
+                print("new osc time %g us" % (osc_time * 1.0e6))
+                print("error %g" % error)
+                print("osc period %g us " % (osc_period * 1.0e6))
+                print("error limit %g us" % (osc_period * window_frac * 1.0e6))
+            if adj_enabled:
+                # a zero factor leaves its term unchanged, so both
+                # adjustments can be applied unconditionally
+                osc_period += error * freq_adj_factor
+                if osc_period < min_osc_period:
+                    osc_period = min_osc_period
+                elif osc_period > max_osc_period:
+                    osc_period = max_osc_period
+                osc_time += error * phase_adj_factor
+
+            # a one for this transition, then zeros up to the next
+            append(1)
+            extend(bytes(hbi - 1))
 
+        self.osc_period = osc_period
+        self.osc_time = osc_time
+        self.trans_time = trans_time
+        return bits
@@ -5,7 +5,8 @@
 # supports operation on arbitrary data word widths
 
 # supports table-driven operation with selectable table size(s)
-# for common 8-bit use, after instantiation, call make_table(8)
+# for common 8-bit use, after instantiation, call make_table(8),
+# or use get_crc(param) to get a shared instance with tables built
 
 # Algorithms defined per section 14 of "A Painless Guide to CRC
 # Error Detection Algorithms" by Ross N. Williams:
@@ -24,9 +25,34 @@
 #    along with this program.  If not, see
 #    <http://www.gnu.org/licenses/>.
 
+import binascii
 from collections import namedtuple
 import struct
 
+
+# constant-time bit reversal for the common word widths
+def _reflect8(x):
+    x &= 0xff
+    return ((x * 0x0202020202) & 0x010884422010) % 1023
+
+def _reflect16(x):
+    x = ((x >> 1) & 0x5555) | ((x & 0x5555) << 1)
+    x = ((x >> 2) & 0x3333) | ((x & 0x3333) << 2)
+    x = ((x >> 4) & 0x0f0f) | ((x & 0x0f0f) << 4)
+    return ((x >> 8) | (x << 8)) & 0xffff
+
+def _reflect32(x):
+    x = ((x >> 1) & 0x55555555) | ((x & 0x55555555) << 1)
+    x = ((x >> 2) & 0x33333333) | ((x & 0x33333333) << 2)
+    x = ((x >> 4) & 0x0f0f0f0f) | ((x & 0x0f0f0f0f) << 4)
+    x = ((x >> 8) & 0x00ff00ff) | ((x & 0x00ff00ff) << 8)
+    return ((x >> 16) | (x << 16)) & 0xffffffff
+
+_reflectors = { 8: _reflect8,
+                16: _reflect16,
+                32: _reflect32 }
+
+
 class CRC:
 
     CRCParam = namedtuple('CRCParam',
@@ -75,50 +101,65 @@ class CRC:
                  param):
         self.tables = { }
         self.cache = { }
+        self.slice_tables = None
         self.param = param
-        self.reg = param.init
         self.widmask = (1 << self.param.order) - 1
         self.topbit = 1 << (self.param.order - 1)
+        # For CRCs with reflected input, the register is kept in the
+        # reflected domain, so input data words never need to be
+        # reflected and the register shifts right.
+        if self.param.refin:
+            self.init = self.reflect(self.param.init, self.param.order)
+            self.poly = self.reflect(self.param.poly, self.param.order)
+            self.xorot = self.reflect(self.param.xorot, self.param.order)
+        else:
+            self.init = self.param.init
+            self.poly = self.param.poly
+            self.xorot = self.param.xorot
+        self.reg = self.init
 
     def reset(self):
-        self.reg = self.param.init
+        self.reg = self.init
         
     def reflect(self, data, bit_count):
-        d1 = data
-        d2 = 0
-        for b in range(bit_count):
-            d2 <<= 1
-            if d1 & 1:
-                d2 |= 1
-            d1 >>= 1
-        #print("%02x %02x" % (data, d2))
-        return d2
+        if bit_count in _reflectors:
+            return _reflectors[bit_count](data)
+        return int('{:0{}b}'.format(data & ((1 << bit_count) - 1), bit_count)[::-1], 2)
                 
+    # The bit loops below are branchless: the polynomial is masked by
+    # the bit being shifted out (-1 if it's set, 0 if not) and always
+    # XORed in.
+
     # this one works only for bit_count <= self.param.order
     def comp1(self, data, bit_count = 8):
+        poly = self.poly
         if self.param.refin:
-            data = self.reflect(data, bit_count)
-        self.reg ^= data << (self.param.order - bit_count)
-        for b in range(bit_count):
-            if self.reg & self.topbit:
-                self.reg = (self.reg << 1) ^ self.param.poly
-            else:
-                self.reg <<= 1
-            self.reg &= self.widmask
+            reg = self.reg ^ (data & ((1 << bit_count) - 1))
+            for b in range(bit_count):
+                reg = (reg >> 1) ^ (poly & -(reg & 1))
+        else:
+            msb_shift = self.param.order - 1
+            mask = self.widmask
+            reg = self.reg ^ (data << (self.param.order - bit_count))
+            for b in range(bit_count):
+                reg = ((reg << 1) ^ (poly & -((reg >> msb_shift) & 1))) & mask
+        self.reg = reg
 
     # this one doesn't restrict bit_count
     def comp2(self, data, bit_count = 8):
+        poly = self.poly
+        reg = self.reg
         if self.param.refin:
-            r = range(bit_count)
+            for b in range(bit_count):
+                reg ^= (data >> b) & 1
+                reg = (reg >> 1) ^ (poly & -(reg & 1))
         else:
-            r = range(bit_count - 1, -1, -1)
-        for b in r:
-            self.reg ^= ((data >> b) & 1) << (self.param.order - 1)
-            if self.reg & self.topbit:
-                self.reg = (self.reg << 1) ^ self.param.poly
-            else:
-                self.reg <<= 1
-            self.reg &= self.widmask
+            msb_shift = self.param.order - 1
+            mask = self.widmask
+            for b in range(bit_count - 1, -1, -1):
+                reg ^= ((data >> b) & 1) << msb_shift
+                reg = ((reg << 1) ^ (poly & -((reg >> msb_shift) & 1))) & mask
+        self.reg = reg
 
     def find_table(self, bit_count):
         self.cache[bit_count] = 0  # assume no suitable table
@@ -127,9 +168,27 @@ class CRC:
                 self.cache[bit_count] = i
                 return
 
+    # reflected input is consumed least significant bits first
+    def comp_int_reflected(self, data, bit_count = 8):
+        while bit_count > 0:
+            if bit_count not in self.cache:
+                self.find_table(bit_count)
+            table_size = self.cache[bit_count]
+            if table_size:
+                mask = (1 << table_size) - 1
+                self.reg = self.tables[table_size][(self.reg ^ data) & mask] ^ (self.reg >> table_size)
+                data >>= table_size
+                bit_count -= table_size
+            else:
+                self.reg ^= data & 1
+                self.reg = (self.reg >> 1) ^ (self.poly & -(self.reg & 1))
+                data >>= 1
+                bit_count -= 1
+
     def comp_int(self, data, bit_count = 8):
         if self.param.refin:
-            data = self.reflect(data, bit_count)
+            self.comp_int_reflected(data, bit_count)
+            return
         while bit_count > 0:
             if bit_count not in self.cache:
                 self.find_table(bit_count)
@@ -141,35 +200,42 @@ class CRC:
                 self.reg &= self.widmask
                 bit_count -= table_size
             else:
+                msb_shift = self.param.order - 1
                 b = (data >> bit_count - 1) & 1
-                self.reg ^= b << (self.param.order - 1)
-                if self.reg & self.topbit:
-                    self.reg = (self.reg << 1) ^ self.param.poly
-                else:
-                    self.reg <<= 1
-                self.reg &= self.widmask
+                self.reg ^= b << msb_shift
+                self.reg = ((self.reg << 1) ^ (self.poly & -((self.reg >> msb_shift) & 1))) & self.widmask
                 bit_count -= 1
 
     def comp(self, data, bit_count = 8):
-        try:
-            for b in data:
-                self.comp_int(b, bit_count)
-        except TypeError:
+        if isinstance(data, int):
             self.comp_int(data, bit_count)
+            return
+        comp_int = self.comp_int
+        for b in data:
+            comp_int(b, bit_count)
+
+    # Used in place of comp() once an 8-bit table exists. Everything but
+    # the table lookup is hoisted out of the per-byte loop.
+    def comp_bytes(self, data, bit_count = 8):
+        if bit_count != 8 or isinstance(data, int):
+            CRC.comp(self, data, bit_count)
+            return
+        if not hasattr(data, '__len__'):
+            data = bytes(data)  # e.g. a generator, which comp() also takes
+        if self.slice_tables and len(data) >= 4:
+            data = self.comp_words(data)
+        reg = self.reg
+        table = self.tables[8]
+        if self.param.refin:
+            for b in data:
+                reg = table[(reg ^ b) & 0xff] ^ (reg >> 8)
+        else:
+            shift = self.param.order - 8
+            mask = self.widmask
+            for b in data:
+                reg = table[(reg >> shift) ^ b] ^ ((reg << 8) & mask)
+        self.reg = reg
 
-    def make_table_entry(self, d, bit_count):
-        v = 0
-        for b in range(bit_count - 1, -1, -1):
-            b = (d >> bit_count - 1) & 1
-            v ^= b << (self.param.order - 1)
-            if v & self.topbit:
-                v = (v << 1) ^ self.param.poly
-            else:
-                v <<= 1
-            v &= self.widmask
-            bit_count -= 1
-        return v
-                        
     def make_table(self, bit_count = 8):
         if bit_count in self.tables:
             return
@@ -177,16 +243,90 @@ class CRC:
 
         self.cache = { }
 
-        self.tables[bit_count] = [self.make_table_entry(i, bit_count) for i in range(1 << bit_count)]
+        if self.param.refin:
+            self.tables[bit_count] = self.make_reflected_table(bit_count)
+        else:
+            self.tables[bit_count] = self.make_normal_table(bit_count)
 
         #for i in range(len(self.tables[bit_count])):
         #    print("%02x: %08x" % (i, self.tables[bit_count][i]))
 
-    def get(self):
-        if self.param.refot:
-            return self.reflect(self.reg ^ self.param.xorot, self.param.order)
+        # byte-at-a-time data gets its own loop once there's a byte table
+        if bit_count == 8 and self.param.order >= 8:
+            self.comp = self.comp_bytes
+
+    # Slicing-by-4: consumes the data four bytes at a time, using one
+    # table per byte position, and returns the leftover tail bytes.
+    def comp_words(self, data):
+        data = bytes(data)
+        count = len(data) // 4
+        t0, t1, t2, t3 = self.slice_tables
+        reg = self.reg
+        if self.param.refin:
+            for x in struct.unpack_from('<%dI' % count, data):
+                x ^= reg
+                reg = t3[x & 0xff] ^ t2[(x >> 8) & 0xff] ^ t1[(x >> 16) & 0xff] ^ t0[x >> 24]
         else:
-            return self.reg ^ self.param.xorot
+            shift = 32 - self.param.order
+            for x in struct.unpack_from('>%dI' % count, data):
+                x ^= reg << shift
+                reg = t3[x >> 24] ^ t2[(x >> 16) & 0xff] ^ t1[(x >> 8) & 0xff] ^ t0[x & 0xff]
+        self.reg = reg
+        return data[count * 4:]
+
+    # Builds the tables for comp_words(). Table k gives the effect of a
+    # byte followed by k zero bytes; table 0 is the ordinary byte table.
+    def make_slice_tables(self):
+        assert 8 <= self.param.order <= 32
+        self.make_table(8)
+        tables = [self.tables[8]]
+        t0 = tables[0]
+        for k in range(1, 4):
+            prev = tables[-1]
+            if self.param.refin:
+                tables.append([t0[v & 0xff] ^ (v >> 8) for v in prev])
+            else:
+                shift = self.param.order - 8
+                tables.append([t0[v >> shift] ^ ((v << 8) & self.widmask) for v in prev])
+        self.slice_tables = tables
+
+    # The CRC of a data word is linear over GF(2), so only the entries
+    # for single-bit data words need the bit loop; every other entry is
+    # the XOR of the entry for its top bit and an entry already built.
+    def make_normal_table(self, bit_count):
+        poly = self.poly
+        msb_shift = self.param.order - 1
+        mask = self.widmask
+        table = [0] * (1 << bit_count)
+        for i in range(bit_count):
+            v = self.topbit
+            for b in range(i + 1):
+                v = ((v << 1) ^ (poly & -((v >> msb_shift) & 1))) & mask
+            base = 1 << i
+            for j in range(base):
+                table[base + j] = v ^ table[j]
+        return table
+
+    # table for the reflected (right-shifting) algorithm, indexed by
+    # the low bits of the register XORed with the data word
+    def make_reflected_table(self, bit_count):
+        poly = self.poly
+        table = [0] * (1 << bit_count)
+        for i in range(bit_count):
+            v = 1 << i
+            for b in range(bit_count):
+                v = (v >> 1) ^ (poly & -(v & 1))
+            base = 1 << i
+            for j in range(base):
+                table[base + j] = v ^ table[j]
+        return table
+
+    # a reflected register needs reflecting again only if the output
+    # isn't reflected
+    def get(self):
+        if self.param.refin == self.param.refot:
+            return self.reg ^ self.xorot
+        return self.reflect(self.reg ^ self.xorot, self.param.order)
 
     def crc(self, data):
         self.reset()
@@ -194,19 +334,65 @@ class CRC:
         return self.get()
 
 
+# binascii.crc_hqx() is the non-reflected 16-bit CRC with polynomial
+# 0x1021, computed in C from whatever initial value it's passed, so it
+# can stand in for comp() for any parameter set of that form.
+def _uses_crc_hqx(param):
+    return (param.order == 16 and param.poly == 0x1021 and
+            not param.refin and not param.refot)
+
+def _comp_hqx(self, data, bit_count = 8):
+    if bit_count != 8 or isinstance(data, int):
+        CRC.comp(self, data, bit_count)
+        return
+    self.reg = binascii.crc_hqx(bytes(data), self.reg)
+
+
+# Shared instances, with tables already built, keyed by parameter set
+# (not by name, since e.g. CRC-16-CCITT is used with differing initial
+# values). Building the tables costs far more than a short CRC, so
+# callers that need a CRC repeatedly should use these.
+_crc_cache = { }
+
+def get_crc(param):
+    crc = _crc_cache.get(param)
+    if crc is None:
+        crc = CRC(param)
+        if _uses_crc_hqx(param):
+            crc.make_table(8)
+            crc.comp = _comp_hqx.__get__(crc)
+        elif 8 <= param.order <= 32:
+            crc.make_slice_tables()  # comp() is then comp_bytes()
+        elif param.order > 32:
+            crc.make_table(8)
+        # else the CRC is narrower than a byte, so an 8-bit table would be
+        # wider than the register; it's computed without tables
+        _crc_cache[param] = crc
+    return crc
+
+
 if __name__ == '__main__':
 
     pass_count = 0
     fail_count = 0
 
-    def test(param, data, expected_value, use_table = True):
+    def test(param, data, expected_value, use_table = True, use_slices = False, shared = False):
         global pass_count, fail_count
-        crc = CRC(param)
-        if use_table:
-            crc.make_table(5)
-            crc.make_table(3)
-        for b in data:
-            crc.comp(b)
+        if shared:
+            crc = get_crc(param)
+            crc.reset()
+            crc.comp(bytes(data))
+        else:
+            crc = CRC(param)
+            if use_table:
+                crc.make_table(5)
+                crc.make_table(3)
+            if use_slices:
+                crc.make_slice_tables()
+                crc.comp(data)
+            else:
+                for b in data:
+                    crc.comp(b)
         v = crc.get()
         if v == expected_value:
             print('%s OK' % param.name)
@@ -228,6 +414,27 @@ if __name__ == '__main__':
     test(CRC.crc32_bzip2_param, vector, 0xfc891918)
     test(CRC.crc32c_param,      vector, 0xe3069283)
 
+    # same, using slicing-by-4 tables
+    test(CRC.crc16_ccitt_param, vector, 0x29b1,     use_slices = True)
+    test(CRC.crc32_param,       vector, 0xcbf43926, use_slices = True)
+    test(CRC.crc32_bzip2_param, vector, 0xfc891918, use_slices = True)
+    test(CRC.crc32c_param,      vector, 0xe3069283, use_slices = True)
+
+    # same, using the shared instances (crc_hqx for CRC-16-CCITT)
+    test(CRC.crc16_ccitt_param, vector, 0x29b1,     shared = True)
+    test(CRC.crc32_param,       vector, 0xcbf43926, shared = True)
+    test(CRC.crc32_bzip2_param, vector, 0xfc891918, shared = True)
+    test(CRC.crc32c_param,      vector, 0xe3069283, shared = True)
+
+
+    # CRCs narrower than a byte, from the same catalogue
+    crc7_mmc_param = CRC.CRCParam('CRC-7/MMC', 7, 0x09, 0x00, 0x00, False, False)
+    crc5_usb_param = CRC.CRCParam('CRC-5/USB', 5, 0x05, 0x1f, 0x1f, True, True)
+    test(crc7_mmc_param, vector, 0x75)
+    test(crc5_usb_param, vector, 0x19)
+    test(crc7_mmc_param, vector, 0x75, shared = True)
+    test(crc5_usb_param, vector, 0x19, shared = True)
+
 
     # Test vectors for CRC-32C from RFC3270:
     #   https://tools.ietf.org/html/rfc3720#appendix-B.4
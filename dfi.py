@@ -19,46 +19,86 @@
 #    <http://www.gnu.org/licenses/>.
 
 import argparse
+from array import array
+from itertools import accumulate, chain, compress, tee
+import operator
+import re
+import struct
 
 from fluximage import CHS, FluxImage, FluxImageBlock
 
+# block header: cylinder, head, sector, data length
+_block_header = struct.Struct('>HHHI')
+
+# Per-byte lookup tables used with bytes.translate(), so that a whole
+# block of data is classified in C rather than byte by byte in Python.
+# The incr tables give the time increment contributed by each byte; the
+# trans tables are nonzero for bytes that mark a flux transition.
+_v1_incr  = bytes([(b & 0x7f) or 127 for b in range(256)])
+_v1_trans = bytes([(b & 0x7f) != 0 for b in range(256)])
+
+_v2_incr  = bytes([b & 0x7f for b in range(256)])
+_v2_trans = bytes([(b & 0x80) == 0 and 0 < b < 0x7f for b in range(256)])
+
+# Index pulses are only a few bytes per block, so they're located with a
+# byte-class regex rather than with another full-length table pass.
+_v2_index_re = re.compile(b'[\x81-\xfe]')
+
+
 class DFIBlock(FluxImageBlock):
+    # Transition times are summed and differenced in one streamed pass
+    # straight into flux_trans_rel, which is what the PLL and histogram
+    # consume; the absolute times are only rebuilt on request.
+    def store_flux_trans(self, incr, trans):
+        abs_iter, next_iter = tee(compress(accumulate(incr), trans))
+        self.first_trans = next(next_iter, None)
+        self.flux_trans_rel = array('q', map(operator.sub, next_iter, abs_iter))
+
+    @property
+    def flux_trans_abs(self):
+        if self.first_trans is None:
+            return array('q')
+        return array('q', accumulate(chain((self.first_trans,), self.flux_trans_rel)))
+
     def parse_data_version_1(self, data):
-        time_inc = 0
-        for b in data:
-            if (b & 0x7f) == 0x00:
-                time_inc += 127
-            else:
-                time_inc += (b & 0x7f)
-                self.flux_trans_abs.append(time_inc)
-        self.end_time = time_inc
+        incr = data.translate(_v1_incr)
+        self.store_flux_trans(incr, data.translate(_v1_trans))
+        self.end_time = sum(incr)
 
+    # a zero byte is ignored (why should there ever be one???), 0x7f
+    # or 0xff adds 127 counts, other bytes with the high bit set are
+    # index pulses, and the rest are flux transitions
     def parse_data_version_2(self, data):
-        time_inc = 0
-        for b in data:
-            if (b & 0x7f) == 0x00:
-                continue  # why should there ever be a zero byte???
-            if (b & 0x7f) == 0x7f:
-                time_inc += 127
-            elif (b & 0x80) != 0:
-                time_inc += (b & 0x7f)
-                self.index_pos.append(time_inc)
-                # break    # XXX break here to only use first revolution
-            else:
-                time_inc += (b & 0x7f)
-                self.flux_trans_abs.append(time_inc)
-        self.end_time = time_inc
+        incr = data.translate(_v2_incr)
+        self.store_flux_trans(incr, data.translate(_v2_trans))
+        self.index_pos = [sum(incr[:m.end()]) for m in _v2_index_re.finditer(data)]
+        self.end_time = sum(incr)
+
+    # raw_data is a view of the whole image, which can't be pickled, and
+    # isn't needed once parsed; sending a copy to every worker would
+    # just double the data pickled
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['raw_data'] = None
+        return state
 
     _parse_data = { 1: parse_data_version_1,
                     2: parse_data_version_2 }
 
-    def __init__(self, fluximagefile, version, frequency, debug = False):
-        super().__init__(fluximagefile, debug)
+    # A DFIBlock is parsed from a memoryview of the whole image, starting
+    # at offset; next_offset is set to the offset of the following block.
+    def __init__(self, buf, offset, version, frequency, debug = False):
+        super().__init__(None, debug)
         self.version = version
         self.frequency = frequency
-        self.cylinder = self.read_u16_be()
-        self.head = self.read_u16_be()
-        self.sector = self.read_u16_be()
+        self.stream_offset = offset
+        if offset + _block_header.size > len(buf):
+            raise EOFError()
+        (self.cylinder,
+         self.head,
+         self.sector,
+         self.data_len) = _block_header.unpack_from(buf, offset)
+        offset += _block_header.size
 
         if self.debug:
             print('version %d, freq %f' % (version, frequency))
@@ -66,12 +106,14 @@ class DFIBlock(FluxImageBlock):
                                                        self.cylinder,
                                                        self.sector))
 
-        self.data_len = self.read_u32_be()
-        self.raw_data = self.read(self.data_len)
+        if offset + self.data_len > len(buf):
+            raise EOFError()
+        self.raw_data = buf[offset : offset + self.data_len]
+        self.next_offset = offset + self.data_len
 
         self.index_pos = []
-        self.flux_trans_abs = []
-        self._parse_data[self.version](self, self.raw_data)
+        # translate() needs a bytes object, so this is the block's only copy
+        self._parse_data[self.version](self, self.raw_data.tobytes())
 
 
 class DFI(FluxImage):
@@ -81,16 +123,21 @@ class DFI(FluxImage):
     def __init__(self, fluximagefile, debug = False, frequency = 25.0e6):
         super().__init__(fluximagefile, debug)
         self.frequency = frequency
-        magic = self.fluximagefile.read(4)
+        # the whole image is read at once, and blocks are parsed from it
+        # by offset without further I/O
+        buf = memoryview(self.fluximagefile.read())
+        magic = bytes(buf[0:4])
         if magic not in self.magic_to_version:
             raise Exception('bad magic ' + str(magic))
         version = self.magic_to_version[magic]
 
         self.blocks = {}
+        offset = 4
         while True:
             try:
-                block = DFIBlock(fluximagefile, version, frequency, debug = self.debug)
+                block = DFIBlock(buf, offset, version, frequency, debug = self.debug)
                 self.blocks[block.chs()] = block
+                offset = block.next_offset
             except EOFError:
                 break
 
@@ -1,9 +1,29 @@
+from array import array
 from collections import Counter, namedtuple
+from itertools import islice, repeat
 import operator
 import struct
 
 CHS = namedtuple('CHS', ['cylinder', 'head', 'sector'])
 
+# precompiled Structs for read_integer(), keyed by
+# (byte count, signed, big endian)
+_integer_structs = { (count, signed, big_endian): struct.Struct('<>' [big_endian] +
+                                                                (code if signed else code.upper()))
+                     for count, code in ((1, 'b'), (2, 'h'), (4, 'i'), (8, 'q'))
+                     for signed in (False, True)
+                     for big_endian in (False, True) }
+
+_s8     = _integer_structs[(1, True,  False)]
+_u16_le = _integer_structs[(2, False, False)]
+_u16_be = _integer_structs[(2, False, True)]
+_s16_le = _integer_structs[(2, True,  False)]
+_s16_be = _integer_structs[(2, True,  True)]
+_u32_le = _integer_structs[(4, False, False)]
+_u32_be = _integer_structs[(4, False, True)]
+_s32_le = _integer_structs[(4, True,  False)]
+_s32_be = _integer_structs[(4, True,  True)]
+
 '''A FluxImageBlock represents one flux image, which is a single track
    for a soft-sectored disk, or a single sector for a hard-sectored disk'''
 class FluxImageBlock:
@@ -12,6 +32,12 @@ class FluxImageBlock:
         self.debug = debug
         self.stream_offset = 0
 
+    # the image file can't be pickled, and isn't needed once parsed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fluximagefile'] = None
+        return state
+
     def chs(self):
         return CHS(self.cylinder, self.head, self.sector)
 
@@ -23,88 +49,75 @@ class FluxImageBlock:
         return d
 
     def read_integer(self, count, signed = False, big_endian = False):
-        fmt = '<>' [big_endian]
-        fmt += { 1: 'b',
-                 2: 'h',
-                 4: 'i',
-                 8: 'q' } [count]
-        if not signed:
-            fmt = fmt.upper()
         d = self.read(count)
-        return struct.unpack(fmt, d) [0]
+        return _integer_structs[(count, signed, big_endian)].unpack(d) [0]
 
+    # a single byte needs no struct at all
     def read_u8(self):
-        return self.read_integer(1)
+        return self.read(1) [0]
 
+    # the fixed-size readers unpack with their Struct directly, rather
+    # than going through read_integer()
     def read_s8(self):
-        return self.read_integer(1, signed = True)
+        return _s8.unpack(self.read(1)) [0]
 
     def read_u16_le(self):
-        return self.read_integer(2)
+        return _u16_le.unpack(self.read(2)) [0]
 
     def read_u16_be(self):
-        return self.read_integer(2, big_endian = True)
+        return _u16_be.unpack(self.read(2)) [0]
 
     def read_s16_le(self):
-        return self.read_integer(2, signed = True)
+        return _s16_le.unpack(self.read(2)) [0]
 
     def read_s16_be(self):
-        return self.read_integer(2, signed = True, big_endian = True)
+        return _s16_be.unpack(self.read(2)) [0]
 
     def read_u32_le(self):
-        return self.read_integer(4)
+        return _u32_le.unpack(self.read(4)) [0]
 
     def read_u32_be(self):
-        return self.read_integer(4, big_endian = True)
+        return _u32_be.unpack(self.read(4)) [0]
 
     def read_s32_le(self):
-        return self.read_integer(4, signed = True)
+        return _s32_le.unpack(self.read(4)) [0]
 
     def read_s32_be(self):
-        return self.read_integer(4, signed = True, big_endian = True)
-
-    class __DeltaIter:
-        def __init__(self, block):
-            block.generate_flux_trans_rel()
-            self.block = block
-            self.index = 0
-
-        def __iter__(self):
-            return self
-
-        def __next__(self):
-            try:
-                v = self.block.flux_trans_rel[self.index] / self.block.frequency
-                self.index += 1
-                return v
-            except IndexError:
-                raise StopIteration
+        return _s32_be.unpack(self.read(4)) [0]
 
     def generate_flux_trans_rel(self):
         if hasattr(self, 'flux_trans_rel'):
             return
-        self.flux_trans_rel = [self.flux_trans_abs[i] - self.flux_trans_abs[i-1] for i in range(1, len(self.flux_trans_abs))]
+        self.flux_trans_rel = array('q', map(operator.sub,
+                                             islice(self.flux_trans_abs, 1, None),
+                                             self.flux_trans_abs))
 
+    # transition deltas in seconds, scaled lazily in C by map()
     def get_delta_iter(self):
-        return self.__DeltaIter(self)
+        self.generate_flux_trans_rel()
+        return map(operator.truediv, self.flux_trans_rel, repeat(self.frequency))
 
     def print_hist(self, bucket_size = 2.5):
         self.generate_flux_trans_rel()
+        # Counter tallies the distinct deltas in C; only those (not every
+        # transition) are then binned into a dense list of buckets
         counts = Counter(self.flux_trans_rel)
-        hist = { }
-        for i in counts.keys():
-            bucket = int((i + bucket_size / 2) // bucket_size)
-            hist[bucket] = hist.get(bucket, 0) + counts[i]
 
-        # maximum value
-        m = max(hist.items(), key=operator.itemgetter(1))[1]
+        def bucket(i):
+            return int((i + bucket_size / 2) // bucket_size)
+
+        # minimum, maximum buckets
+        f = bucket(min(counts))
+        l = bucket(max(counts))
 
-        # minimum, maximum keys
-        f = min(hist.items(), key=operator.itemgetter(0))[0]        
-        l = max(hist.items(), key=operator.itemgetter(0))[0]        
+        hist = [0] * (l + 1 - f)
+        for i, c in counts.items():
+            hist[bucket(i) - f] += c
+
+        # maximum value
+        m = max(hist)
 
-        for i in range(f, l + 1):
-            c = hist.get(i, 0)
+        for i, c in enumerate(hist, f):
             s = '*' * int(65*c/m)
             if len(s) == 0 and c != 0:
                 s = '.'
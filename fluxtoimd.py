@@ -16,47 +16,57 @@
 #    <http://www.gnu.org/licenses/>.
 
 import argparse
-import re
-from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
+from itertools import chain
+import sys
 
 from dfi import DFI      # DiscFerret image format
 from kfsf import KFSF    # KryoFlux stream format
 from adpll import ADPLL
-from crc import CRC
+from crc import CRC, get_crc
 from modulation import FM, MFM, IntelM2FM, HPM2FM
 from imagedisk import ImageDisk
 
 
+# translate() table from PLL output values to ASCII '0' and '1'
+_channel_bit_chars = b'01' + bytes(254)
+
+
+# translate() table for the ASCII column of a hex dump
+_hex_dump_chars = bytes(c if 0x20 <= c <= 0x7e else ord('.') for c in range(256))
+
+
+# The dump is formatted a row at a time and written out once, rather
+# than printed a character at a time.
 def hex_dump(b, prefix = ''):
+    b = bytes(b)
+    lines = []
     for i in range(0, len(b), 16):
-        print(prefix + '%02x: ' % i, end='')
-        for j in range(16):
-            if (i + j) < len(b):
-                print('%02x ' % b[i+j], end='')
-            else:
-                print('   ', end='')
-        for j in range(16):
-            if (i + j) < len(b):
-                if 0x20 <= b[i+j] <= 0x7e:
-                    print('%c' % b[i+j], end='')
-                else:
-                    print('.', end='')
-        print()
+        row = b[i:i+16]
+        lines.append('%s%02x: %-48s%s\n' % (prefix,
+                                            i,
+                                            row.hex(' ') + ' ',
+                                            row.translate(_hex_dump_chars).decode('ascii')))
+    sys.stdout.write(''.join(lines))
 
 
 def dump_track(modulation,
-               image,
+               block,
                track,
                side,  # 0 or 1
+               crc,
+               hbc,   # half-bit cycle in s
                sectors_per_track = None,
                require_index_mark = False):
 
     if sectors_per_track is None:
         sectors_per_track = modulation.default_sectors_per_track
 
-    sectors = OrderedDict()
-
-    block = image.blocks[(track, side, 1)]
+    # keyed by sector number, in the order the sectors were found on the
+    # track, which is the order they're written to the ImageDisk image
+    sectors = { }
 
     di = block.get_delta_iter()
 
@@ -68,34 +78,48 @@ def dump_track(modulation,
                   phase_adj_factor = 0.1)
 
 
-    bits = ''
-    for b in adpll:
-        bits += '01'[b]
+    # the PLL decodes the whole track into a buffer of 0/1 values, which
+    # map to the ASCII channel bit string in one translate()
+    bits = adpll.decode_all().translate(_channel_bit_chars).decode('ascii')
     #print(len(bits))
     #print(bits)
 
     if require_index_mark:
-        index_address_mark_locs = [m.start() for m in re.finditer(modulation.index_address_mark, bits)]
-        if not index_address_mark_locs:
+        if not modulation.index_address_mark_re.search(bits):
             print('track %d: no index address mark found' % track)
             return sectors
 
-    id_address_mark_locs = [m.start() for m in re.finditer(modulation.id_address_mark, bits)]
+    id_address_mark_locs = [m.start() for m in modulation.id_address_mark_re.finditer(bits)]
     #print('id address marks at: ', id_address_mark_locs)
 
+    # the modulation's parameters and the CRC methods are bound to
+    # locals, since they're used for every ID field on the track
+    decode = modulation.decode
+    id_mark_len = len(modulation.id_address_mark)
+    id_field_length = modulation.id_field_length
+    id_field_end = id_mark_len + 16 * (id_field_length + 2)
+    expected_sector_sizes = modulation.expected_sector_sizes
+    crc_start = 0 if modulation.crc_includes_address_mark else 1
+    data_mark_search = modulation.data_address_mark_re.search
+    data_mark_len = len(modulation.data_address_mark)
+    if hasattr(modulation, 'deleted_data_address_mark_re'):
+        deleted_data_mark_search = modulation.deleted_data_address_mark_re.search
+    else:
+        deleted_data_mark_search = None
+    crc_reset = crc.reset
+    crc_comp = crc.comp
+    crc_get = crc.get
+
     for id_pos in id_address_mark_locs:
         #print('id address mark at channel bit %d' % id_pos)
-        id_field = modulation.decode(bits[id_pos: id_pos + len(modulation.id_address_mark) + 16 * (modulation.id_field_length + 2)])
-        crc.reset()
-        if (modulation.crc_includes_address_mark):
-            crc.comp(id_field)
-        else:
-            crc.comp(id_field[1:])
-        if crc.get() != 0:
-            print("*** bad ID field CRC %04x" % crc.get())
+        id_field = decode(bits[id_pos: id_pos + id_field_end])
+        crc_reset()
+        crc_comp(id_field[crc_start:])
+        if crc_get() != 0:
+            print("*** bad ID field CRC %04x" % crc_get())
             hex_dump(id_field)
             continue
-        if modulation.id_field_length == 2:
+        if id_field_length == 2:
             # HP M2FM ID field only contains two bytes for track and sector
             id_track, id_sector = id_field[1:3]
             if id_sector < 0x80:
@@ -117,22 +141,31 @@ def dump_track(modulation,
             continue
 
         bc = 128 << id_size
-        if bc not in modulation.expected_sector_sizes:
+        if bc not in expected_sector_sizes:
             print("*** ID field with unexpected sector size")
             hex_dump(id_field)
-        if (id_sector in sectors) and (sectors[id_sector][1] is not None) and not sectors[id_sector][2]:
+        prev = sectors.get(id_sector)
+        if (prev is not None) and (prev[1] is not None) and not prev[2]:
             continue  # already have this one and it was a good read
         # Mark sector bad to start with
         sectors[id_sector] = [False, None, True]
 
         deleted = False
-        data_pos = bits.find(modulation.data_address_mark, id_pos + len(modulation.id_address_mark) + 16 * (modulation.id_field_length + 2))
-        if (modulation.id_to_data_half_bits - 50) <= (data_pos - id_pos) <= (modulation.id_to_data_half_bits + 50):
+        # read only once a good ID field is found, as not every modulation
+        # (e.g. MFM) defines it
+        id_to_data = modulation.id_to_data_half_bits
+        # a mark starting beyond the window would be rejected anyway, so
+        # the searches needn't look any further than that
+        window_end = id_pos + id_to_data + 50 + data_mark_len
+        m = data_mark_search(bits, id_pos + id_field_end, window_end)
+        data_pos = m.start() if m else -1
+        if (id_to_data - 50) <= (data_pos - id_pos) <= (id_to_data + 50):
             #print('  data address mark at channel bit offset %d' % (data_pos - id_pos))
             pass
-        elif hasattr(modulation, 'deleted_data_address_mark'):
-            data_pos = bits.find(modulation.deleted_data_address_mark, id_pos + len(modulation.id_address_mark) + 96)
-            if (modulation.id_to_data_half_bits - 50) <= (data_pos - id_pos) <= (modulation.id_to_data_half_bits + 50):
+        elif deleted_data_mark_search is not None:
+            m = deleted_data_mark_search(bits, id_pos + id_mark_len + 96, window_end)
+            data_pos = m.start() if m else -1
+            if (id_to_data - 50) <= (data_pos - id_pos) <= (id_to_data + 50):
                 #print('  deleted data address mark at channel bit offset %d' % (deleted_data_pos - id_pos))
                 deleted = True
             else:
@@ -144,13 +177,10 @@ def dump_track(modulation,
             hex_dump(id_field)
             continue
 
-        data_field = modulation.decode(bits[data_pos: data_pos + len(modulation.id_address_mark) + (bc + 2) * 16])
-        crc.reset()
-        if (modulation.crc_includes_address_mark):
-            crc.comp(data_field)
-        else:
-            crc.comp(data_field[1:])
-        if crc.get() == 0:
+        data_field = decode(bits[data_pos: data_pos + id_mark_len + (bc + 2) * 16])
+        crc_reset()
+        crc_comp(data_field[crc_start:])
+        if crc_get() == 0:
             sectors [id_sector] = (deleted, data_field[1:bc+1], False)
         else:
             print("*** bad data field CRC track %d side %d sector %d" % (track, side, id_sector))
@@ -161,80 +191,125 @@ def dump_track(modulation,
     return sectors
 
 
-parser = argparse.ArgumentParser(description = 'DFI library test, prints flux transition time histogram for a chosen track',
-                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('flux_image', type=argparse.FileType('rb'))
-parser.add_argument('imagedisk_image', type=argparse.FileType('wb'))
-parser.add_argument('-C', '--comment', action = 'store')
-
-parser.add_argument('-F', '--flux_format', choices=['dfi', 'ksf'], default = 'dfi')
-
-parser_modulation = parser.add_mutually_exclusive_group(required = False)
-parser_modulation.add_argument('--fm',   action = 'store_const', const = FM,   dest = 'modulation', help = 'FM modulation, IBM 3740 single density')
-parser_modulation.add_argument('--mfm',  action = 'store_const', const = MFM,  dest = 'modulation', help = 'MFM modulation, IBM System/34 double density')
-parser_modulation.add_argument('--intelm2fm', action = 'store_const', const = IntelM2FM, dest = 'modulation', help = 'M2FM modulation, Intel MDS, SBC 202 double density')
-parser_modulation.add_argument('--hpm2fm', action = 'store_const', const = HPM2FM, dest = 'modulation', help = 'M2FM modulation, HP 7902/9885/9895 double density')
-
-parser.set_defaults(modulation = FM)
-
-parser.add_argument('-s', '--sides',      type=int, default = 1, choices = [1, 2], help='number of sides')
-parser.add_argument('-t', '--tracks',     type=int, default = 77, help='number of tracks')
-
-parser.add_argument('-f', '--frequency',  type=float, help = 'sample rate in MHz', default=25.0)
-parser.add_argument('-b', '--bit-rate',   type=float, help = 'bit rate in Kbps')
-parser.add_argument('--index',            action = 'store_true', help = 'require tracks to have index address marks')
-parser.add_argument('-v', '--verbose',    action = 'store_true')
-args = parser.parse_args()
-
-if args.flux_format == 'dfi':
-    flux_image = DFI(args.flux_image, frequency = args.frequency * 1.0e6)
-elif args.flux_format == 'ksf':
-    flux_image = KFSF(args.flux_image)
-
-if args.modulation == HPM2FM and args.index:
-    print("index mark option ignored, as HP M2FM doesn't use index marks")
-    args.index = False
-
-if args.imagedisk_image is not None:
-    if args.comment is not None:
-        imd = ImageDisk(comment=args.comment)
+def modulation_crc(modulation):
+    crc_param = CRC.CRCParam(name = 'CRC-16-CCITT',
+                             order = 16,
+                             poly = 0x1021,
+                             init = modulation.crc_init,
+                             xorot = 0x0000,
+                             refin = modulation.lsb_first,
+                             refot = False)
+    return get_crc(crc_param)
+
+
+# runs dump_track() in a worker process, returning its result along with
+# anything it printed
+def dump_track_job(job):
+    modulation, block, track, side, hbc, require_index_mark = job
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        sectors = dump_track(modulation, block, track, side, modulation_crc(modulation), hbc,
+                             require_index_mark = require_index_mark)
+    return sectors, output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'DFI library test, prints flux transition time histogram for a chosen track',
+                                         formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('flux_image', type=argparse.FileType('rb'))
+    parser.add_argument('imagedisk_image', type=argparse.FileType('wb'))
+    parser.add_argument('-C', '--comment', action = 'store')
+
+    parser.add_argument('-F', '--flux_format', choices=['dfi', 'ksf'], default = 'dfi')
+
+    parser_modulation = parser.add_mutually_exclusive_group(required = False)
+    parser_modulation.add_argument('--fm',   action = 'store_const', const = FM,   dest = 'modulation', help = 'FM modulation, IBM 3740 single density')
+    parser_modulation.add_argument('--mfm',  action = 'store_const', const = MFM,  dest = 'modulation', help = 'MFM modulation, IBM System/34 double density')
+    parser_modulation.add_argument('--intelm2fm', action = 'store_const', const = IntelM2FM, dest = 'modulation', help = 'M2FM modulation, Intel MDS, SBC 202 double density')
+    parser_modulation.add_argument('--hpm2fm', action = 'store_const', const = HPM2FM, dest = 'modulation', help = 'M2FM modulation, HP 7902/9885/9895 double density')
+
+    parser.set_defaults(modulation = FM)
+
+    parser.add_argument('-s', '--sides',      type=int, default = 1, choices = [1, 2], help='number of sides')
+    parser.add_argument('-t', '--tracks',     type=int, default = 77, help='number of tracks')
+
+    parser.add_argument('-f', '--frequency',  type=float, help = 'sample rate in MHz', default=25.0)
+    parser.add_argument('-b', '--bit-rate',   type=float, help = 'bit rate in Kbps')
+    parser.add_argument('--index',            action = 'store_true', help = 'require tracks to have index address marks')
+    parser.add_argument('-j', '--jobs',       type=int, default = 1, help = 'number of worker processes for reading and decoding tracks')
+    parser.add_argument('--cache-dir',        help = 'directory for caching parsed KryoFlux streams; cache files are unpickled, so it must be trusted')
+    parser.add_argument('-v', '--verbose',    action = 'store_true')
+    args = parser.parse_args()
+
+    if args.flux_format == 'dfi':
+        flux_image = DFI(args.flux_image, frequency = args.frequency * 1.0e6)
+    elif args.flux_format == 'ksf':
+        flux_image = KFSF(args.flux_image, jobs = args.jobs, cache_dir = args.cache_dir)
+
+    if args.modulation == HPM2FM and args.index:
+        print("index mark option ignored, as HP M2FM doesn't use index marks")
+        args.index = False
+
+    if args.imagedisk_image is not None:
+        if args.comment is not None:
+            imd = ImageDisk(comment=args.comment)
+        else:
+            imd = ImageDisk()
+
+    if args.bit_rate is None:
+        args.bit_rate = args.modulation.default_bit_rate_kbps
+
+
+    hbr = args.bit_rate * 2000   # half-bit rate in Hz
+    hbc = 1/hbr                  # half-bit cycle in s
+
+
+    first_sector = args.modulation.default_first_sector
+    sectors_per_track = args.modulation.default_sectors_per_track
+
+    bad_sectors = 0
+    data_sectors = 0
+    deleted_sectors = 0
+    total_sectors = 0
+
+
+    track_coords = [(track_num, side_num) for track_num in range(args.tracks) for side_num in range(args.sides)]
+    if args.jobs > 1:
+        # Tracks are independent, so they're decoded in worker processes.
+        # Each worker's output is captured and printed here, in track order.
+        # Only the tracks up to the first missing one are decoded; that one
+        # raises KeyError when its turn comes, just as in the serial path.
+        decoded_coords = track_coords
+        for i, (track_num, side_num) in enumerate(track_coords):
+            if (track_num, side_num, 1) not in flux_image.blocks:
+                decoded_coords = track_coords[:i]
+                break
+        with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+            results = executor.map(dump_track_job,
+                                   [(args.modulation,
+                                     flux_image.blocks[(track_num, side_num, 1)],
+                                     track_num,
+                                     side_num,
+                                     hbc,
+                                     args.index) for track_num, side_num in decoded_coords])
+            results = list(results)
+        results = chain(results,
+                        (flux_image.blocks[(track_num, side_num, 1)]
+                         for track_num, side_num in track_coords[len(decoded_coords):]))
     else:
-        imd = ImageDisk()
-
-if args.bit_rate is None:
-    args.bit_rate = args.modulation.default_bit_rate_kbps
-
-
-crc_param = CRC.CRCParam(name = 'CRC-16-CCITT',
-                         order = 16,
-                         poly = 0x1021,
-                         init = args.modulation.crc_init,
-                         xorot = 0x0000,
-                         refin = args.modulation.lsb_first,
-                         refot = False)
-
-
-crc = CRC(crc_param)
-crc.make_table(8)
-
-
-hbr = args.bit_rate * 2000   # half-bit rate in Hz
-hbc = 1/hbr                  # half-bit cycle in s
-
-
-first_sector = args.modulation.default_first_sector
-sectors_per_track = args.modulation.default_sectors_per_track
-
-bad_sectors = 0
-data_sectors = 0
-deleted_sectors = 0
-total_sectors = 0
-
-
-#tracks = { }
-for track_num in range(args.tracks):
-    for side_num in range(args.sides):
-        track = dump_track(args.modulation, flux_image, track_num, side_num, require_index_mark = args.index)
+        crc = modulation_crc(args.modulation)
+        results = ((dump_track(args.modulation,
+                               flux_image.blocks[(track_num, side_num, 1)],
+                               track_num,
+                               side_num,
+                               crc,
+                               hbc,
+                               require_index_mark = args.index), '')
+                   for track_num, side_num in track_coords)
+
+    #tracks = { }
+    for (track_num, side_num), (track, output) in zip(track_coords, results):
+        sys.stdout.write(output)
         #tracks[(track_num, side_num)] = track
         if args.verbose:
             print('track %2d' % track_num, end='')
@@ -285,8 +360,11 @@ for track_num in range(args.tracks):
                     print('*** BAD nodata: track %02d sector %02d\n' % (track_num, sector_num))
                     pass
 
-if args.imagedisk_image is not None:
-    imd.write(args.imagedisk_image)
+    if args.imagedisk_image is not None:
+        imd.write(args.imagedisk_image)
+
+    print('%d data sectors, %d deleted data sectors, %d bad sectors, out of %d' % (data_sectors, deleted_sectors, bad_sectors, total_sectors))
 
-print('%d data sectors, %d deleted data sectors, %d bad sectors, out of %d' % (data_sectors, deleted_sectors, bad_sectors, total_sectors))
 
+if __name__ == '__main__':
+    main()
@@ -22,11 +22,16 @@
 
 import argparse
 import datetime
+import struct
 from collections import OrderedDict
 
 from modulation import FM, MFM, IntelM2FM
 
 
+# track header: mode, cylinder, head, sector count, sector size code
+_track_header = struct.Struct('BBBBB')
+
+
 class ImageDisk:
     class NotImageDiskFileException(Exception):
         pass
@@ -44,6 +49,9 @@ class ImageDisk:
         pass
 
     class Sector:
+        # no per-instance __dict__, as there's one of these per sector
+        __slots__ = ('mode', 'deleted', 'size_code', 'data', 'bad')
+
         def __init__(self, mode, deleted, size_code, data, bad):
             self.mode = mode
             self.deleted = deleted
@@ -64,21 +72,22 @@ class ImageDisk:
         if track_coord not in self.tracks:
             self.tracks[track_coord] = OrderedDict()
         if (not replace_ok) and (sector in self.tracks[track_coord]):
-            raise DuplicateSectorException('duplicate sector, cyl=%d, head=%d, sector=%d' % (cylinder, head, sector))
-        if len(data) not in self.__sector_size_map:
-            raise InvalidSectorSizeException('invalid sector size, cyl=%d, head=%d, sector=%d, size=%d' % (cylinder, head, sector, len(data)))
-        self.tracks[track_coord][sector] = ImageDisk.Sector(mode, deleted, self.__sector_size_map[len(data)], data, bad)
+            raise ImageDisk.DuplicateSectorException('duplicate sector, cyl=%d, head=%d, sector=%d' % (cylinder, head, sector))
+        size_code = self.__sector_size_map.get(len(data))
+        if size_code is None:
+            raise ImageDisk.InvalidSectorSizeException('invalid sector size, cyl=%d, head=%d, sector=%d, size=%d' % (cylinder, head, sector, len(data)))
+        self.tracks[track_coord][sector] = ImageDisk.Sector(mode, deleted, size_code, data, bad)
 
 
     def __read_track(self, f):
-        header = f.read(5)
-        if len(header) != 5:
+        header = f.read(_track_header.size)
+        if len(header) != _track_header.size:
             raise EOFError()
-        mode = header[0]
-        cylinder = header[1]
-        head = header[2]
-        sector_count = header[3]
-        sector_size_code = header[4]
+        (mode,
+         cylinder,
+         head,
+         sector_count,
+         sector_size_code) = _track_header.unpack(header)
         sector_size_codes = [sector_size_code] * sector_count
         sector_numbers = f.read(sector_count)
         # XXX optional cylinder map not yet supported
@@ -108,10 +117,26 @@ class ImageDisk:
             # XXX read header
             s = f.read(4)
             if s != b'IMD ':
-                raise NotImageDiskFileException()
-            c = 0
-            while c != bytes([0x1a]):
-                c = f.read(1)
+                raise ImageDisk.NotImageDiskFileException()
+            # skip the rest of the header and comment, up to the 0x1a
+            # terminator, reading a block at a time and seeking back if
+            # the file allows it, else (e.g. a pipe) a byte at a time
+            if f.seekable():
+                while True:
+                    chunk = f.read(4096)
+                    if not chunk:
+                        raise ImageDisk.NotImageDiskFileException()
+                    i = chunk.find(0x1a)
+                    if i >= 0:
+                        f.seek(i + 1 - len(chunk), 1)
+                        break
+            else:
+                while True:
+                    c = f.read(1)
+                    if not c:
+                        raise ImageDisk.NotImageDiskFileException()
+                    if c == b'\x1a':
+                        break
             while True:
                 try:
                     self.__read_track(f)
@@ -132,48 +157,49 @@ class ImageDisk:
             raise NonexistentSectorException()
         return data
 
-    def __write_track(self, f, tc):
-        mode = None
+    # The track is appended to the bytearray out; write() issues a
+    # single write() for the whole image.
+    def __write_track(self, out, tc):
         track = self.tracks[tc]
-        sector_count = len(track)
-        sector_size_code = None
-        for sector_number in track:
-            sector = track[sector_number]
-            if mode is None:
-                mode = sector.mode
-            elif mode != sector.mode:
-                raise MixedModeTrackException('mixed modes, cyl=%d, head=%d' % tc)
-            if sector_size_code is None:
-                sector_size_code = sector.size_code
-            elif sector_size_code != sector.size_code:
-                sector_size_code = 0xff  # indicate mixed sector sizes
-            
-        f.write(bytes([mode,
-                       tc[0], # cylinder
-                       tc[1], # head
-                       sector_count,
-                       sector_size_code]))
-        f.write(bytes(track.keys())) # sector map
+        sectors = list(track.values())
+        mode = sectors[0].mode
+        sector_size_code = sectors[0].size_code
+        # nearly every track has a single mode and sector size, so check
+        # for that in one pass, and only sort out which it is otherwise
+        if not all(sector.mode == mode and sector.size_code == sector_size_code
+                   for sector in sectors):
+            if any(sector.mode != mode for sector in sectors):
+                raise ImageDisk.MixedModeTrackException('mixed modes, cyl=%d, head=%d' % tc)
+            size_codes = bytes(sector.size_code for sector in sectors)
+            sector_size_code = 0xff  # indicate mixed sector sizes
+
+        out += _track_header.pack(mode,
+                                  tc[0], # cylinder
+                                  tc[1], # head
+                                  len(sectors),
+                                  sector_size_code)
+        out += bytes(track.keys()) # sector map
         # XXX doesn't currently support the optional cylinder map
         # XXX doesn't currently support the optional head map
         if sector_size_code == 0xff:
-            # write sector size map
-            f.write(bytes([sector.size_code for sector in track]))
-        for sector_number in track:
-            if track[sector_number].deleted:
+            out += size_codes  # sector size map
+        for sector in sectors:
+            if sector.deleted:
                 data_code = 0x03
             else:
                 data_code = 0x01
-            if track[sector_number].bad:
+            if sector.bad:
                 data_code = data_code + 0x04;
-            data = track[sector_number].data
-            compress = data[1:] == data[:-1]
+            data = sector.data
+            # a sector filled with a single value is stored compressed;
+            # count() checks that without copying the data
+            compress = data.count(data[0:1]) == len(data)
             if compress:
-                f.write(bytes([data_code + 1]))
-                f.write(data[0:1])
+                out.append(data_code + 1)
+                out += data[0:1]
             else:
-                f.write(bytes([data_code]))
-                f.write(data)
+                out.append(data_code)
+                out += data
 
 
     def write(self, f):
@@ -184,14 +210,15 @@ class ImageDisk:
 
         # write header
         dt = self.timestamp.strftime('%d/%m/%Y %H:%M:%S')
-        f.write(bytes('IMD 1.18 %s\r\n' % dt, encoding='ascii'))
+        out = bytearray(bytes('IMD 1.18 %s\r\n' % dt, encoding='ascii'))
         if self.comment is not None:
-            f.write(bytes(self.comment + '\r\n', 'utf-8'))
-        f.write(bytes([0x1a]))
+            out += bytes(self.comment + '\r\n', 'utf-8')
+        out.append(0x1a)
 
         tl = sorted(self.tracks.keys())
         for tc in tl:
-            self.__write_track(f, tc)
+            self.__write_track(out, tc)
+        f.write(out)
 
         if do_close:
             f.close()
@@ -230,8 +257,11 @@ if __name__ == '__main__':
 
     imd = ImageDisk()  # no file, so creating a new image
     
+    # write_sector() doesn't modify the data, so all sectors share one buffer
+    data = bytes([args.data]) * bytes_per_sector
+
     head = 0
     for track in range(args.tracks):
         for sector in range(1, sectors + 1):
-            imd.write_sector(args.modulation.imagedisk_mode, track, head, sector, bytes([args.data] * bytes_per_sector))
+            imd.write_sector(args.modulation.imagedisk_mode, track, head, sector, data)
     imd.write(args.image)
@@ -19,11 +19,40 @@
 #    <http://www.gnu.org/licenses/>.
 
 import argparse
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import io
+from itertools import accumulate
+import os
+import pickle
 import re
+import struct
+import sys
+import tempfile
 import zipfile
 
 from fluximage import FluxImage, FluxImageBlock
 
+# KryoFlux stream file names in a zip archive end in trackNN.H.raw
+_track_filename_re = re.compile(r'track([0-9]{2})\.([0-9])\.raw$')
+
+# an Info block's text is name=value fields separated by ', '
+_info_field_re = re.compile(r'([^,=]+)=([^,]*)(?:, |$)')
+
+# OOB block header, following the 0x0d: type, length
+_oob_header = struct.Struct('<BH')
+
+# OOB block payloads, each unpacked from a single read
+_oob_stream_info = struct.Struct('<II')   # stream_pos, xfer_time
+_oob_index       = struct.Struct('<III')  # next_flux_stream_pos, sample_counter, index_counter
+_oob_stream_end  = struct.Struct('<II')   # stream_pos, result_code
+
+# a (possibly empty) run of Flux1 cells
+_flux1_run_re = re.compile(b'[\x0e-\xff]*')
+
 class KyroFluxStreamOOBBlock:
     def __init__(self, kfs, length):
         self.kfs = kfs
@@ -49,8 +78,7 @@ class KyroFluxStreamOOBBlock:
     
     @classmethod
     def factory(cls, kfs):
-        oob_type = kfs.read_u8()
-        oob_length = kfs.read_u16_le()
+        oob_type, oob_length = _oob_header.unpack(kfs.read(_oob_header.size))
         if oob_type not in cls.oob_type_map:
             raise Exception('Unknown OOB block type %02x' % oob_type)
         return cls.oob_type_map[oob_type](kfs, oob_length)
@@ -58,11 +86,10 @@ class KyroFluxStreamOOBBlock:
 @KyroFluxStreamOOBBlock.register_subclass(0x01)
 class KyroFluxStreamInfo(KyroFluxStreamOOBBlock):
     def read_oob_payload(self):
-        self.stream_pos = self.kfs.read_u32_le()
-        pos_error = self.kfs.block_offset - self.stream_pos
-        self.xfer_time  = self.kfs.read_u32_le()
+        self.stream_pos, self.xfer_time = _oob_stream_info.unpack(self.kfs.read(_oob_stream_info.size))
 
         if (self.kfs.debug):
+            pos_error = self.kfs.block_offset - self.stream_pos
             print('StreamInfo at %d' % self.kfs.block_offset)
             print('  stream_pos:     %d' % self.stream_pos, end='')
             if pos_error:
@@ -76,9 +103,9 @@ class KyroFluxIndex(KyroFluxStreamOOBBlock):
         self.index_number = self.kfs.index_count
         self.kfs.index_count += 1
         
-        self.next_flux_stream_pos  = self.kfs.read_u32_le()
-        self.sample_counter        = self.kfs.read_u32_le()
-        self.index_counter         = self.kfs.read_u32_le()
+        (self.next_flux_stream_pos,
+         self.sample_counter,
+         self.index_counter) = _oob_index.unpack(self.kfs.read(_oob_index.size))
 
         if self.kfs.debug:
             print('Index %d at stream %d' % (self.index_number, self.kfs.block_offset))
@@ -96,12 +123,11 @@ class KyroFluxIndex(KyroFluxStreamOOBBlock):
 @KyroFluxStreamOOBBlock.register_subclass(0x03)
 class KyroFluxStreamEnd(KyroFluxStreamOOBBlock):
     def read_oob_payload(self):
-        self.stream_pos  = self.kfs.read_u32_le()
-        pos_error = self.kfs.block_offset - self.stream_pos
-        self.result_code = self.kfs.read_u32_le()
+        self.stream_pos, self.result_code = _oob_stream_end.unpack(self.kfs.read(_oob_stream_end.size))
         self.kfs.stream_end = True
 
         if self.kfs.debug:
+            pos_error = self.kfs.block_offset - self.stream_pos
             print('StreamEnd at %d' % self.kfs.block_offset)
             print('  stream_pos:     %d' % self.stream_pos, end='')
             if pos_error:
@@ -115,8 +141,8 @@ class KyroFluxInfo(KyroFluxStreamOOBBlock):
         text = self.kfs.read(self.length).decode('ascii')
         if text[-1] != '\x00':
             raise Exception('Info text not null-terminated')
-        fields = [i.split('=') for i in text[:-1].split(', ')]
-        self.kfs.info.update(dict(fields))
+        fields = _info_field_re.findall(text, 0, len(text) - 1)
+        self.kfs.info.update(fields)
 
         if self.kfs.debug:
             print('Info at %d' % self.kfs.block_offset)
@@ -132,6 +158,61 @@ class KyroFluxEOF(KyroFluxStreamOOBBlock):
             print('Logical EOF at %d' % self.kfs.block_offset)
 
 class KyroFluxStream(FluxImageBlock):
+    # The whole stream is read into memory at once, and these readers
+    # take bytes from the buffer. pos is the position in the buffer,
+    # which differs from stream_offset, as OOB blocks don't count toward
+    # the latter.
+    def read(self, count):
+        d = self.buf[self.pos : self.pos + count]
+        if len(d) != count:
+            raise EOFError()
+        self.pos += count
+        self.stream_offset += count
+        return d
+
+    def read_u8(self):
+        try:
+            v = self.buf[self.pos]
+        except IndexError:
+            raise EOFError()
+        self.pos += 1
+        self.stream_offset += 1
+        return v
+
+    # Records a run of Flux1 cells, the bulk of any stream, with the
+    # counter sums done by accumulate() rather than a call per cell.
+    # The run is split at any flux that resolves a pending index block,
+    # and that flux alone goes through flux_change().
+    def flux1_run(self, data):
+        start = self.stream_offset
+        end = start + len(data)
+        i = 0
+        for k in sorted(k for k in self.pending_index_blocks if start < k <= end):
+            self.flux_segment(data[i : k - start - 1])
+            self.read_u8()
+            self.flux_change(data[k - start - 1])
+            i = k - start
+        self.flux_segment(data[i:])
+
+    # a run of Flux1 cells, none of which resolves an index block
+    def flux_segment(self, data):
+        if not data:
+            return
+        counters = list(accumulate(data, initial = self.flux_sample_counter + self.overflow))
+        self.overflow = 0
+
+        # Discard all flux transitions before index pulse
+        if self.index_abs:
+            first = bisect_right(counters, self.index_abs[0], 1)
+            # fromlist() copies straight from the list, without the
+            # per-item iteration that extend() does
+            self.flux_trans_abs.fromlist(counters[first:])
+
+        self.flux_sample_counter = counters[-1]
+        self.prev_flux_sample_counter = counters[-1]
+        self.pos += len(data)
+        self.stream_offset += len(data)
+
     def flux_change(self, offset):
         # record flux change here
         self.flux_sample_counter += self.overflow + offset
@@ -152,6 +233,47 @@ class KyroFluxStream(FluxImageBlock):
         if self.debug:
             print('flux at %d' % self.flux_sample_counter)
 
+    # handlers for the in-band opcodes, called with the opcode byte
+
+    def flux2(self, bt):
+        self.flux_change((bt << 8) + self.read_u8())
+
+    def nop(self, bt):
+        self.read(bt - 0x08)  # Nop1, Nop2, Nop3 skip 0, 1, 2 bytes
+
+    def ovl16(self, bt):
+        self.overflow += 0x10000
+        if self.debug:
+            print('overflow')
+
+    # the Flux3 value is big-endian, like a Flux2 cell's
+    def flux3(self, bt):
+        self.flux_change(self.read_u16_be())
+
+    def oob(self, bt):
+        block = KyroFluxStreamOOBBlock.factory(self)
+        self.oob_blocks.append(block)
+        if isinstance(block, KyroFluxIndex):
+            self.pending_index_blocks[block.next_flux_stream_pos] = block
+
+    def flux1(self, bt):
+        if self.debug:
+            self.flux_change(bt)
+            return
+        # the rest of the run of Flux1 cells is handled in bulk
+        end = _flux1_run_re.match(self.buf, self.pos).end()
+        self.pos -= 1
+        self.stream_offset -= 1
+        self.flux1_run(self.buf[self.pos : end])
+
+    # dispatch table indexed by opcode byte
+    opcode_handlers = ([flux2] * 8 +           # 0x00..0x07: Flux2
+                       [nop] * 3 +             # 0x08..0x0a: Nop1..Nop3
+                       [ovl16,                 # 0x0b: Ovl16
+                        flux3,                 # 0x0c: Flux3
+                        oob] +                 # 0x0d: OOB
+                       [flux1] * (256 - 0x0e)) # 0x0e..0xff: Flux1
+
     def get_block(self):
         self.block_offset = self.stream_offset
         try:
@@ -162,30 +284,12 @@ class KyroFluxStream(FluxImageBlock):
             return
         if bt != 0x0d and self.stream_end:
             raise Exception('In-band data past stream end')
-        if bt <= 0x07:  # Flux2
-            self.flux_change((bt << 8) + self.read_u8())
-        elif bt == 0x08: # Nop1
-            pass
-        elif bt == 0x09: # Nop2
-            self.read(1)
-        elif bt == 0x0a: # Nop3
-            self.read(2)
-        elif bt == 0x0b: # Ovl16
-            self.overflow += 0x10000
-            if self.debug:
-                print('overflow')
-        elif bt == 0x0c: # Flux3
-            self.flux_change(self.read_u16_le)
-        elif bt == 0x0d: # OOB
-            block = KyroFluxStreamOOBBlock.factory(self)
-            self.oob_blocks.append(block)
-            if isinstance(block, KyroFluxIndex):
-                self.pending_index_blocks[block.next_flux_stream_pos] = block
-        else: # 0x0e..0xff: Flux1
-            self.flux_change(bt)
+        self.opcode_handlers[bt](self, bt)
 
     def __init__(self, fluximagefile, debug = False):
         super().__init__(fluximagefile, debug)
+        self.buf = fluximagefile.read()
+        self.pos = 0
         self.info = { }
         self.overflow = 0
         self.stream_end = False
@@ -193,7 +297,7 @@ class KyroFluxStream(FluxImageBlock):
 
         self.prev_flux_sample_counter = 0
         self.flux_sample_counter = 0
-        self.flux_trans_abs = [ ]
+        self.flux_trans_abs = array('q')
 
         self.oob_blocks = [ ]
 
@@ -212,35 +316,128 @@ class KyroFluxStream(FluxImageBlock):
         if self.pending_index_blocks:
             print('%d unresolved index blocks' % len(self.pending_index_blocks))
 
+        # the raw stream isn't needed once parsed, and would otherwise be
+        # pickled along with the block
+        del self.buf
+
+
+# Version of the parsed stream cache; bump it whenever a parser change
+# alters the parsed result or the layout of a pickled KyroFluxStream, so
+# that stale cache entries are no longer used.
+_cache_version = 1
+
+# Parses a stream file. If cache_dir is given, the parsed stream, along
+# with anything printed while parsing it, is cached there in a file named
+# by the cache version and a hash of the raw stream, so that opening the
+# same stream again skips parsing. Debugging output isn't cached, so debug
+# bypasses the cache. Cache entries are unpickled, so cache_dir must be a
+# trusted directory.
+def _parse_stream(f, debug = False, cache_dir = None):
+    if cache_dir is None or debug:
+        return KyroFluxStream(f, debug = debug)
+
+    data = f.read()
+    path = os.path.join(cache_dir,
+                        'kfs-v%d-%s.pickle' % (_cache_version,
+                                               hashlib.blake2b(data, digest_size = 16).hexdigest()))
+    try:
+        with open(path, 'rb') as cf:
+            block, output = pickle.load(cf)
+        sys.stdout.write(output)
+        return block
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass  # not cached, or unreadable, so parse it again
+
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            block = KyroFluxStream(io.BytesIO(data))
+    finally:
+        sys.stdout.write(output.getvalue())
+
+    # written under a temporary name then renamed, so that other processes
+    # never see a partial file; the cache is optional, so a failure to
+    # write it is ignored, and the parsed stream returned regardless
+    temp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok = True)
+        fd, temp_path = tempfile.mkstemp(dir = cache_dir, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as cf:
+            pickle.dump((block, output.getvalue()), cf)
+        os.replace(temp_path, path)
+    except (OSError, pickle.PicklingError):
+        if temp_path is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+    return block
+
+
+# parses one track's stream file from a zip archive, returning the
+# KyroFluxStream, or the exception that prevented parsing it
+def _read_track(zf, fn, debug, cache_dir):
+    try:
+        with zf.open(fn) as f:
+            return _parse_stream(f, debug = debug, cache_dir = cache_dir)
+    except Exception as e:
+        return e
+
+
+# runs _read_track() in a worker process, which opens the archive itself,
+# returning its result along with anything it printed
+def _read_track_job(job):
+    path, fn, debug, cache_dir = job
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with zipfile.ZipFile(path) as zf:
+            block = _read_track(zf, fn, debug, cache_dir)
+    return block, output.getvalue()
+
 
 class KFSF(FluxImage):
-    def __init__(self, fluximagefile, debug = False):
+    def __init__(self, fluximagefile, debug = False, jobs = 1, cache_dir = None):
         super().__init__(fluximagefile, debug)
         
-        try:
+        # is_zipfile() only probes for the end of central directory
+        # record, but it moves the file position, so a raw stream must be
+        # read from a seek back to the start
+        if zipfile.is_zipfile(fluximagefile):
             zf = zipfile.ZipFile(fluximagefile)
-        except:
+        else:
             zf = None
 
         if zf is None:
             head = 0
             track = 0
-            fluximagefile.seek(0)
-            self.blocks[(track, head, 1)] = KyroFluxStream(fluximagefile, debug = debug)
+            fluximagefile.seek(0)  # needed, as is_zipfile() moved it
+            self.blocks[(track, head, 1)] = _parse_stream(fluximagefile, debug = debug, cache_dir = cache_dir)
         else:
+            tracks = []
             for fn in zf.namelist():
                 #print(fn)
-                m = re.match('.*track([0-9]{2})\.([0-9])\.raw$', fn)
+                m = _track_filename_re.search(fn)
                 if m:
-                    head = int(m.group(2))
-                    track = int(m.group(1))
-                    if True:
-                        print('reading head %d track %02d' % (head, track))
-                    try:
-                        with zf.open(fn) as f:
-                            self.blocks[(track, head, 1)] = KyroFluxStream(f, debug = debug)
-                    except Exception as e:
-                        print('%s reading head %d track %02d' % (str(e), head, track))
+                    tracks.append((int(m.group(1)), int(m.group(2)), fn))
+
+            results = None
+            if jobs > 1:
+                # Track streams are independent, so they're parsed in worker
+                # processes. Each worker's output is printed here, in order.
+                with ProcessPoolExecutor(max_workers = jobs) as executor:
+                    results = list(executor.map(_read_track_job,
+                                                [(fluximagefile.name, fn, debug, cache_dir) for track, head, fn in tracks]))
+
+            for i, (track, head, fn) in enumerate(tracks):
+                if True:
+                    print('reading head %d track %02d' % (head, track))
+                if results is None:
+                    block = _read_track(zf, fn, debug, cache_dir)
+                else:
+                    block, output = results[i]
+                    sys.stdout.write(output)
+                if isinstance(block, Exception):
+                    print('%s reading head %d track %02d' % (str(block), head, track))
+                else:
+                    self.blocks[(track, head, 1)] = block
 
 
 # test program accepts command line arguments for 
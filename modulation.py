@@ -15,27 +15,72 @@
 #    along with this program.  If not, see
 #    <http://www.gnu.org/licenses/>.
 
+import re
+
+
+# translate() table reversing the bit order of each byte
+_reverse_bits = bytes(int(format(i, '08b')[::-1], 2) for i in range(256))
+
+
+# Address marks are strings of channel bits ('0' or '1'), as searched for
+# in the output of the PLL. They're built by these shared encoders once,
+# when the modulation classes are defined.
+
+# a mark with explicitly given clock bits, as used by FM and M2FM
+def _encode_mark(data, clock, lsb_first = False):
+    if lsb_first:
+        bit_order = range(0, 8)
+    else:
+        bit_order = range(7, -1, -1)
+    bits = ''
+    for i in bit_order:
+        c = (clock >> i) & 1
+        d = (data  >> i) & 1
+        bits += ('%d%d' % (c, d))
+    return bits
+
+# an MFM mark, with clock bits following the MFM rule except for one
+# missing clock bit in the first byte
+# missing_clock1 bit comes after data1 bit numbered with leftmost bit 0
+def _encode_mfm_mark(data1, missing_clock1, data2):
+    prev_d = 0
+    bits = ''
+    for i in range(7, -1, -1):
+        d = (data1  >> i) & 1
+        if (prev_d == 0) and (d == 0) and (i != (6 - missing_clock1)):
+            c = 1
+        else:
+            c = 0
+        bits += ('%d%d' % (c, d))
+        prev_d = d
+    for i in range(7, -1, -1):
+        d = (data2  >> i) & 1
+        if prev_d == 0 and d == 0:
+            c = 1
+        else:
+            c = 0
+        bits += ('%d%d' % (c, d))
+        prev_d = d
+    return bits
+
 
 class Modulation:
     # bits is a string of channel bits ('0' or '1'), which are nominally
     # pairs of (clock, data)
     # XXX this presently doesn't verify that the clock bits meet the
     # encoding rules
+    # The data bits are every other channel bit; they're converted to
+    # bytes all at once by int(), and any trailing partial byte dropped.
     @classmethod
     def decode(cls, channel_bits):
-        bytes = []
-        bits = ''
-        for i in range(0, len(channel_bits), 2):
-            clock = int(channel_bits[i])
-            data = int(channel_bits[i+1])
-            if cls.lsb_first:
-                bits = '01'[data] + bits
-            else:
-                bits += '01'[data]
-            if len(bits) == 8:
-                bytes.append(int(bits, 2))
-                bits = ''
-        return bytes
+        data_bits = channel_bits[1::2]
+        byte_count = len(data_bits) // 8
+        if byte_count == 0:
+            return b''
+        data = int(data_bits[:byte_count * 8], 2).to_bytes(byte_count, 'big')
+        if cls.lsb_first:
+            data = data.translate(_reverse_bits)
+        return data
     
 
 # FM is IBM 3740 single-density format
@@ -58,22 +103,17 @@ class FM(Modulation):
 
     id_to_data_half_bits = 400
 
-    # Would prefer to use a more general @staticmethod encode, but then can't call in
-    # class initialization
-    def encode_mark(data, clock):
-        bits = ''
-        for i in range(7, -1, -1):
-            c = (clock >> i) & 1
-            d = (data  >> i) & 1
-            bits += ('%d%d' % (c, d))
-        return bits
-
-    index_address_mark         = encode_mark(0xfc, clock = 0xd7)
-    id_address_mark            = encode_mark(0xfe, clock = 0xc7)
-    data_address_mark          = encode_mark(0xfb, clock = 0xc7)
-    deleted_data_address_mark  = encode_mark(0xf8, clock = 0xc7)
+    index_address_mark         = _encode_mark(0xfc, clock = 0xd7)
+    id_address_mark            = _encode_mark(0xfe, clock = 0xc7)
+    data_address_mark          = _encode_mark(0xfb, clock = 0xc7)
+    deleted_data_address_mark  = _encode_mark(0xf8, clock = 0xc7)
 
-    del encode_mark
+    # the marks are searched for on every track, so each class compiles
+    # its patterns once, here
+    index_address_mark_re        = re.compile(index_address_mark)
+    id_address_mark_re           = re.compile(id_address_mark)
+    data_address_mark_re         = re.compile(data_address_mark)
+    deleted_data_address_mark_re = re.compile(deleted_data_address_mark)
 
 
 # MFM is IBM System/34 double-density format
@@ -93,36 +133,15 @@ class MFM(Modulation):
     crc_init = 0xffff
     crc_includes_address_mark = True
 
-    # Would prefer to use a more general @staticmethod encode, but then can't call in
-    # class initialization
-    # missing_clock1 bit comes after data1 bit numbered with leftmost bit 0
-    def encode_mark(data1, missing_clock1, data2):
-        prev_d = 0
-        bits = ''
-        for i in range(7, -1, -1):
-            d = (data1  >> i) & 1
-            if (prev_d == 0) and (d == 0) and (i != (6 - missing_clock1)):
-                c = 1
-            else:
-                c = 0
-            bits += ('%d%d' % (c, d))
-            prev_d = d
-        for i in range(7, -1, -1):
-            d = (data2  >> i) & 1
-            if prev_d == 0 and d == 0:
-                c = 1
-            else:
-                c = 0
-            bits += ('%d%d' % (c, d))
-            prev_d = d
-        return bits
-
-    index_address_mark         = encode_mark(0xc2, 5, 0xfc)
-    id_address_mark            = encode_mark(0xa1, 4, 0xfe)
-    data_address_mark          = encode_mark(0xa1, 4, 0xfb)
-    deleted_data_address_mark  = encode_mark(0xa1, 4, 0xf8)
-
-    del encode_mark
+    index_address_mark         = _encode_mfm_mark(0xc2, 5, 0xfc)
+    id_address_mark            = _encode_mfm_mark(0xa1, 4, 0xfe)
+    data_address_mark          = _encode_mfm_mark(0xa1, 4, 0xfb)
+    deleted_data_address_mark  = _encode_mfm_mark(0xa1, 4, 0xf8)
+
+    index_address_mark_re        = re.compile(index_address_mark)
+    id_address_mark_re           = re.compile(id_address_mark)
+    data_address_mark_re         = re.compile(data_address_mark)
+    deleted_data_address_mark_re = re.compile(deleted_data_address_mark)
     
 
 
@@ -152,22 +171,15 @@ class IntelM2FM(Modulation):
 
     id_to_data_half_bits = 600
 
-    # Would prefer to use a more general @staticmethod encode, but then can't call in
-    # class initialization
-    def encode_mark(data, clock):
-        bits = ''
-        for i in range(7, -1, -1):
-            c = (clock >> i) & 1
-            d = (data  >> i) & 1
-            bits += ('%d%d' % (c, d))
-        return bits
+    index_address_mark         = _encode_mark(0x0c, clock = 0x71)
+    id_address_mark            = _encode_mark(0x0e, clock = 0x70)
+    data_address_mark          = _encode_mark(0x0b, clock = 0x70)
+    deleted_data_address_mark  = _encode_mark(0x08, clock = 0x72)
 
-    index_address_mark         = encode_mark(0x0c, clock = 0x71)
-    id_address_mark            = encode_mark(0x0e, clock = 0x70)
-    data_address_mark          = encode_mark(0x0b, clock = 0x70)
-    deleted_data_address_mark  = encode_mark(0x08, clock = 0x72)
-
-    del encode_mark
+    index_address_mark_re        = re.compile(index_address_mark)
+    id_address_mark_re           = re.compile(id_address_mark)
+    data_address_mark_re         = re.compile(data_address_mark)
+    deleted_data_address_mark_re = re.compile(deleted_data_address_mark)
 
 
 # An HP-proprietary M2FM floppy format, used by the HP 7902, 9885,
@@ -202,22 +214,15 @@ class HPM2FM(Modulation):
 
     id_to_data_half_bits = 480
 
-    # Would prefer to use a more general @staticmethod encode, but then can't call in
-    # class initialization
-    def encode_mark(data, clock):
-        bits = ''
-        for i in range(0, 8):
-            c = (clock >> i) & 1
-            d = (data  >> i) & 1
-            bits += ('%d%d' % (c, d))
-        return bits
-
-    id_address_mark              = encode_mark(0x70, clock = 0x0e)
-    defective_track_address_mark = encode_mark(0xf0, clock = 0x0e)
-    data_address_mark            = encode_mark(0x50, clock = 0x0e)
-    ecc_data_address_mark        = encode_mark(0xd0, clock = 0x0e)
-
-    del encode_mark
+    id_address_mark              = _encode_mark(0x70, clock = 0x0e, lsb_first = True)
+    defective_track_address_mark = _encode_mark(0xf0, clock = 0x0e, lsb_first = True)
+    data_address_mark            = _encode_mark(0x50, clock = 0x0e, lsb_first = True)
+    ecc_data_address_mark        = _encode_mark(0xd0, clock = 0x0e, lsb_first = True)
+
+    id_address_mark_re              = re.compile(id_address_mark)
+    defective_track_address_mark_re = re.compile(defective_track_address_mark)
+    data_address_mark_re            = re.compile(data_address_mark)
+    ecc_data_address_mark_re        = re.compile(ecc_data_address_mark)
 
 
 if __name__ == '__main__':